@@ -29,17 +29,43 @@ __status__ = "Production"
 __date__ = "2021/08/12"
 __version__ = "1.0.3"
 
-import configparser
+import concurrent.futures
+import functools
+import itertools
 import logging
 import os
 import re
+import socket
+import struct
+import subprocess
 import sys
 import time
 from datetime import datetime, timedelta
 
+try:
+    import syslog
+except ImportError:  # not available on windows
+    syslog = None
+
 logger = logging.getLogger(__name__)
 
+DEVNULL = subprocess.DEVNULL
+
+# ping command prefix (single echo request + timeout option) according to OS
+PING_CMD = ['ping', '-c', '1', '-W']
+if os.name == 'nt':
+    PING_CMD = ['ping', '-n', '1', '-w']
+
+# ICMP echo request/reply types and unique id source for in-process pings
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+_icmp_seq = itertools.count(1)
+
+# resolved ping hosts: {host: (ipv4 address, expiration time)}
+_dns_cache = {}
+
 
+@functools.lru_cache(maxsize=1)
 def script_full_path_name():
     '''
     Return the full path and the name of this script
@@ -58,9 +84,10 @@ class MyLog:
     '''
 
     log_msg = '(ping-watchdog) ping failed. requesting reboot'
+    syslog_opened = False
 
     def __init__(self, log_max_size=0, fn=None):
-        self.log_max_size = log_max_size
+        self.log_max_size = int(log_max_size)
         self.log_file = fn
         if not fn:
             self.log_file = script_full_path_name() + '.log'
@@ -97,12 +124,12 @@ class MyLog:
         '''
         Truncate/empty log file if oversized
         '''
-        if int(self.log_max_size) > 0:
+        if self.log_max_size > 0:
             fsize = os.path.getsize(self.log_file)
             if fsize > self.log_max_size:
                 logger.debug('log file too large. trucating log file')
-                with open(self.log_file, 'w') as f:
-                    pass
+                # keep the file handler's (append mode) descriptor valid
+                os.truncate(self.log_file, 0)
             else:
                 logger.debug('log rotation not required')
         else:
@@ -114,8 +141,89 @@ class MyLog:
         send system log notification message
         '''
         logger.fatal(MyLog.log_msg)
-        if os.name != 'nt':
-            os.system('logger "%s"' % MyLog.log_msg)
+        if syslog:
+            if not MyLog.syslog_opened:
+                syslog.openlog('ping-watchdog')
+                MyLog.syslog_opened = True
+            syslog.syslog(syslog.LOG_ALERT, MyLog.log_msg)
+
+
+# reboot entry in the log file: "<asctime> | <log_msg>", timestamp captured
+_REBOOT_LINE = re.compile(
+    rb'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})[^|]*\| ' +
+    re.escape(MyLog.log_msg.encode()))
+
+
+class IniSection(dict):
+    '''
+    Config file section, a dict with ConfigParser's getint()
+    '''
+
+    def getint(self, setting):
+        return int(self[setting])
+
+
+class IniConfig(dict):
+    '''
+    Config file contents, {section: IniSection} with ConfigParser's
+    get() and set() as used by MyConfig
+    '''
+
+    def get(self, section, setting):
+        return self[section][setting]
+
+    def set(self, section, setting, value):
+        self[section][setting.lower()] = value
+
+
+def _fast_read_ini(fn):
+    '''
+    Read a config file into an IniConfig, faster than ConfigParser.
+    Only plain files are handled: whole line comments, '=' or ':' delimiters,
+    case-insensitive (lowercase) settings, stripped values. Return None if
+    the file uses anything else (%-interpolation, multi-line values, DEFAULT
+    section, duplicates, syntax errors): ConfigParser must read it then
+
+    >>> import io, unittest.mock
+    >>> def read(ini):
+    ...     with unittest.mock.patch('builtins.open',
+    ...                              return_value=io.StringIO(ini)):
+    ...         return _fast_read_ini('ping-watchdog.conf')
+    >>> config = read('[ping]\\n; comment\\nHost = 1.2.3.4\\n\\nattempts: 4\\n')
+    >>> config
+    {'ping': {'host': '1.2.3.4', 'attempts': '4'}}
+    >>> config['ping'].getint('attempts')
+    4
+    >>> config.set('ping', 'Timeout', '2')
+    >>> config.get('ping', 'timeout')
+    '2'
+    >>> read('[reboot]\\nreboot_cmd_win = shutdown /r %%x\\n') is None
+    True
+    >>> read('[reboot]\\nreboot_cmd_nix = sudo\\n  shutdown\\n') is None
+    True
+    '''
+    config = IniConfig()
+    section = None
+    with open(fn) as f:
+        for raw_line in f:
+            line = raw_line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if '%' in line or raw_line[0].isspace():
+                return None
+            if line[0] == '[':
+                name = line[1:line.rfind(']')]
+                if not name or name == 'DEFAULT' or name in config:
+                    return None
+                section = config[name] = IniSection()
+                continue
+            pos = min(line.find(d) if d in line else len(line) for d in '=:')
+            setting = line[:pos].strip().lower()
+            if section is None or not setting or pos == len(line) \
+                    or setting in section:
+                return None
+            section[setting] = line[pos + 1:].strip()
+    return config
 
 
 class MyConfig():
@@ -149,9 +257,10 @@ class MyConfig():
         '''
         Create or read a configuration file
         '''
-        self.config = configparser.ConfigParser()
         # create config file if not already exists
         if not os.path.isfile(self.config_file):
+            import configparser
+            self.config = configparser.ConfigParser()
             logger.debug("config file not found")
             logger.debug("creating default config file")
             for section, settings in self.items.items():
@@ -168,7 +277,11 @@ class MyConfig():
                     sys.exit(1)
         # config file exists. read from config file
         else:
-            self.config.read(self.config_file)
+            self.config = _fast_read_ini(self.config_file)
+            if self.config is None:
+                import configparser
+                self.config = configparser.ConfigParser()
+                self.config.read(self.config_file)
         return self.config
 
     def get_config_value(self, section, setting):
@@ -176,9 +289,9 @@ class MyConfig():
         Return a setting value
         '''
         if not self.config:
-            self.config = self.read_config()
+            self._create_read_config()
 
-        value = self.config.get(self.main_section, setting)
+        value = self.config.get(section, setting)
 
         return value
 
@@ -194,32 +307,40 @@ class MyConfig():
 
 
 class Pushover:
+    # never let a stalled connection block the reboot
+    timeout = 5
+
     def __init__(self, key, token):
         self.key = key
         self.token = token
 
     def notify(self):
         """Send a pushover message"""
-        import http.client
-        import urllib
-        import socket
-
         if len(self.key) < 30 or len(self.token) < 30:
             logger.debug('pushover not properly configured')
             return
 
+        # only needed on the reboot path, keep them off the healthy one
+        import http.client
+        import urllib.parse
+
         text = "ping failed. performing reboot for %s" % socket.gethostname()
         content = {"message": text, "user": self.key, "token": self.token}
         sent = True
         try:
-            conn = http.client.HTTPSConnection("api.pushover.net:443")
-            conn.request("POST", "/1/messages.json",
-                         urllib.parse.urlencode(content),
-                         {"Content-type": "application/x-www-form-urlencoded"})
-            response = conn.getresponse()
-            if int(response.status) != 200:
-                sent = False
-        except:
+            conn = http.client.HTTPSConnection("api.pushover.net:443",
+                                               timeout=Pushover.timeout)
+            try:
+                conn.request("POST", "/1/messages.json",
+                             urllib.parse.urlencode(content),
+                             {"Content-type": "application/x-www-form-urlencoded"})
+                response = conn.getresponse()
+                if int(response.status) != 200:
+                    sent = False
+            finally:
+                conn.close()
+        # best effort: nothing may prevent the reboot that follows
+        except Exception:
             sent = False
 
         if not sent:
@@ -235,67 +356,234 @@ def is_tool(name):
     return which(name) is not None
 
 
+def icmp_checksum(data):
+    '''
+    Return the internet checksum (RFC 1071) of `data`
+
+    >>> hex(icmp_checksum(bytes.fromhex('0001f203f4f5f6f7')))
+    '0x220d'
+    >>> hex(icmp_checksum(bytes.fromhex('0800000000010001')))
+    '0xf7fd'
+    '''
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%iH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def icmp_socket():
+    '''
+    Return an ICMP socket: unprivileged datagram socket if allowed by the
+    kernel (see net.ipv4.ping_group_range), raw socket otherwise (root).
+    Raises OSError if neither is available
+    '''
+    try:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_ICMP)
+    except OSError:
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                             socket.IPPROTO_ICMP)
+
+
+def _resolve_cached(host, ttl=300):
+    '''
+    Return the IPv4 address of `host` or None if it has none.
+    Successful lookups are cached for `ttl` seconds
+    '''
+    ip, expires_at = _dns_cache.get(host, (None, 0))
+    if time.monotonic() < expires_at:
+        return ip
+    try:
+        ip = socket.getaddrinfo(host, None, socket.AF_INET)[0][4][0]
+    # UnicodeError: invalid name, e.g. 'bad..host'
+    except (socket.gaierror, UnicodeError):
+        return None
+    _dns_cache[host] = (ip, time.monotonic() + ttl)
+    return ip
+
+
+def has_address(host):
+    '''Check whether `host` resolves to an address of any family'''
+    try:
+        return bool(socket.getaddrinfo(host, None))
+    except (socket.gaierror, UnicodeError):
+        return False
+
+
+def is_icmp_reply(data, payload):
+    '''
+    Check whether `data`, as received from an ICMP socket, is the echo reply
+    carrying `payload`. Raw sockets (and some OSes) also deliver the ip header
+
+    >>> is_icmp_reply(bytes(8) + b'abc', b'abc')
+    True
+    >>> is_icmp_reply(b'\\x45' + bytes(19) + bytes(8) + b'abc', b'abc')
+    True
+    >>> is_icmp_reply(b'\\x08' + bytes(7) + b'abc', b'abc')
+    False
+    >>> is_icmp_reply(bytes(8) + b'xyz', b'abc')
+    False
+    '''
+    if data and data[0] >> 4 == 4:
+        data = data[(data[0] & 0x0f) * 4:]
+    # kernel may rewrite the id, so match reply by payload
+    return data[:1] == bytes([ICMP_ECHO_REPLY]) and data[8:] == payload
+
+
+def icmp_ping(ip, timeout):
+    '''
+    Send a single ICMP echo request to IPv4 address `ip` and wait up to
+    `timeout` seconds for the reply. Return 0 on success, 1 otherwise
+    (like ping)
+    '''
+    ident = os.getpid() & 0xffff
+    seq = next(_icmp_seq) & 0xffff
+    payload = struct.pack('!HHd', ident, seq, time.time())
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + payload)
+    packet = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum,
+                         ident, seq) + payload
+
+    deadline = time.monotonic() + timeout
+    try:
+        with icmp_socket() as sock:
+            sock.sendto(packet, (ip, 0))
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return 1
+                sock.settimeout(remaining)
+                if is_icmp_reply(sock.recv(1024), payload):
+                    return 0
+    except OSError:
+        return 1
+
+
+def icmp_available():
+    '''Check whether in-process ICMP pings are possible'''
+    try:
+        icmp_socket().close()
+    except OSError:
+        return False
+    return True
+
+
 def ping_attempts(cfg):
-    '''Perform ping attempts'''
-    if not is_tool('ping'):
+    '''
+    Perform ping attempts. Return the number of failed attempts at the
+    moment the outcome was decided (pings still running are not counted)
+    '''
+    p = cfg.config['ping']
+    host = p['host']
+    timeout = p.getint('timeout')
+    attempts = p.getint('attempts')
+    num_pings = 2 * attempts
+
+    # prefer in-process ICMP over spawning one ping process per attempt.
+    # ICMP sockets are IPv4 only: IPv6 hosts are left to the ping command
+    ip = _resolve_cached(host)
+    use_icmp = icmp_available()
+    if use_icmp and ip:
+        def ping(_):
+            return icmp_ping(ip, timeout)
+    elif use_icmp and not has_address(host):
+        # host does not resolve (e.g. network/dns down): every ping fails
+        def ping(_):
+            return 1
+    elif is_tool('ping'):
+        cmd = PING_CMD + [str(timeout), ip or host]
+
+        def ping(_):
+            return subprocess.call(cmd, stdout=DEVNULL, stderr=DEVNULL)
+    else:
         logger.fatal('ping command not found')
         sys.exit(1)
 
-    output = '/dev/null'
-    ping_cmd = 'ping -c 1 -W'
-    if os.name == 'nt':
-        ping_cmd = 'ping -n 1 -w'
-        output = 'NUL'
-
-    failed_attempts = 0
-    for _ in range(0, 2 * int(cfg.config['ping']['attempts'])):
-        logger.debug('pinging %s' % cfg.config['ping']['host'])
-        result = os.system('%s %i %s > %s 2>&1' %
-                           (ping_cmd, int(cfg.config['ping']['timeout']), cfg.config['ping']['host'], output))
-        if result != 0:
-            failed_attempts += 1
+    # out of 2 * attempts pings, at most `attempts` may fail: stop as soon as
+    # the outcome is decided. The first attempts + 1 pings run concurrently
+    # (enough to decide if all pass or all fail), later ones only as needed
+    passed_attempts = failed_attempts = 0
+    logger.debug('pinging %s (up to %i times)' % (host, num_pings))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=attempts + 1)
+    try:
+        running = set()
+        needed = attempts + 1
+        while passed_attempts < attempts and failed_attempts <= attempts:
+            while len(running) < needed:
+                running.add(pool.submit(ping, None))
+            done, running = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.result() != 0:
+                    failed_attempts += 1
+                else:
+                    passed_attempts += 1
+            needed = min(attempts - passed_attempts,
+                         attempts + 1 - failed_attempts)
+    finally:
+        # outcome decided: don't wait for pings that are still running
+        pool.shutdown(wait=False)
 
     return failed_attempts
 
 
 def ping_host(cfg):
+    p = cfg.config['ping']
+    attempts = p.getint('attempts')
+    retries = p.getint('retries')
+    retry_wait = p.getint('retry_wait')
+
     count = 0
-    while count < int(cfg.config['ping']['retries']):
+    while count < retries:
         if count > 0:
-            logger.debug("waiting %ss for the next ping retry" %
-                         cfg.config['ping']['retry_wait'])
-            time.sleep(int(cfg.config['ping']['retry_wait']))
+            logger.debug("waiting %ss for the next ping retry" % retry_wait)
+            time.sleep(retry_wait)
         failed_attempts = ping_attempts(cfg)
         logger.debug("ping failed attempts: %s" % failed_attempts)
-        if failed_attempts <= int(cfg.config['ping']['attempts']):
+        if failed_attempts <= attempts:
             return True
         count += 1
 
     return False
 
 
+def read_lines_reversed(fn, chunk_size=64 * 1024):
+    '''
+    Yield the lines of a file (as bytes) from last to first,
+    reading it backwards in chunks
+    '''
+    with open(fn, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        rest = b''
+        while pos > 0:
+            size = min(chunk_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + rest).split(b'\n')
+            # first line may be incomplete, keep it for the next chunk
+            rest = lines.pop(0)
+            yield from reversed(lines)
+        yield rest
+
+
 def num_reboots_24h(cfg):
     '''
     Return number of reboots in the last 24h
     '''
-    dt_lst = []
-    with open(cfg.config['log']['log_file'], 'r') as f:
-        lines = f.readlines()
-        for line in lines:
-            try:
-                dt, rest = line.split('|')
-                if rest.find(MyLog.log_msg) != -1:
-                    dt, *_ = dt.split(',')  # discard milisecs
-                    dt, *_ = dt.split('.')  # discard milisecs
-                    dt_lst.append(datetime.strptime(dt, '%Y-%m-%d %H:%M:%S'))
-            except Exception:
-                continue
-
+    # iso-like timestamps sort lexicographically, so compare them as bytes
     yesterday = datetime.today() - timedelta(hours=24)
+    yesterday = yesterday.strftime('%Y-%m-%d %H:%M:%S').encode()
     count = 0
-    for log_date in dt_lst:
-        if log_date > yesterday:
-            count = count + 1
+    # log is chronological: scan from the end, stop at the first old entry
+    for line in read_lines_reversed(cfg.config['log']['log_file']):
+        m = _REBOOT_LINE.match(line)
+        if not m:
+            continue
+        if m.group(1) <= yesterday:
+            break
+        count = count + 1
 
     return count
 
@@ -317,18 +605,21 @@ def send_reboot_cmd(cfg):
 
 
 def notify_and_reboot(cfg):
+    max_reboots = cfg.config['reboot'].getint('max_reboots_per_day')
+    pushover = cfg.config['pushover']
+
     # check reboot threshold
     reboots = num_reboots_24h(cfg)
     logger.debug("number of reboot attemps in the last 24h: %s " % reboots)
-    if reboots >= int(cfg.config['reboot']['max_reboots_per_day']):
+    if reboots >= max_reboots:
         logger.fatal("reboot canceled. max reboots allowed in 24h reached")
     # send notification and perform reboot
     else:
         # send system/log and push notification before reboot command
         MyLog.notify()
         # send push notification
-        push = Pushover(cfg.config['pushover']['pushover_user_key'],
-                        cfg.config['pushover']['pushover_api_token'])
+        push = Pushover(pushover['pushover_user_key'],
+                        pushover['pushover_api_token'])
         push.notify()
         # finally reboot
         if not send_reboot_cmd(cfg):